@@ -12,15 +12,26 @@
 # ==========================================
 
 import os
+import re
+import copy
+import math
+import sys
+import json
 import time
 import uuid
+import bisect
 import random
+import socket
+import hashlib
 import threading
-from collections import deque
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque, Counter, OrderedDict
 from datetime import datetime, timedelta, timezone
 
 # Web Framework
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
 # Machine Learning & Data Science
@@ -42,6 +53,39 @@ CORS(app)  # Enable Cross-Origin Resource Sharing (allows frontend to call API d
 # to restrict access to sensitive endpoints like /feedback and /save.
 API_KEY = os.getenv("API_KEY") 
 
+# Sharded deployment (optional)
+# Run several nodes and consistent-hash each user_id to one of them. Every node lists all nodes
+# as "shard_id=base_url" pairs and names itself with SHARD_ID, e.g.
+#   SHARD_NODES="s0=http://127.0.0.1:8001,s1=http://127.0.0.1:8002"  SHARD_ID="s0"
+# Leave both unset for the classic single-node mode.
+# Shard ids end up as the "<shard_id>." prefix of recommendation_ids, so they may not contain
+# ".", "=" or ","; misconfiguration fails at startup instead of silently misrouting feedback.
+def parse_shard_nodes(raw):
+    """Parses SHARD_NODES into { shard_id: base_url }. Raises ValueError on malformed entries."""
+    nodes = {}
+    for entry in raw.split(","):
+        if not entry.strip():
+            continue
+        if "=" not in entry:
+            raise ValueError(f"SHARD_NODES entry '{entry.strip()}' must be 'shard_id=base_url'")
+        shard_id, url = (part.strip() for part in entry.split("=", 1))
+        if not shard_id or re.search(r"[.=,\s]", shard_id):
+            raise ValueError(f"Invalid shard id '{shard_id}' (must be non-empty, without '.', '=', ',' or spaces)")
+        if not url:
+            raise ValueError(f"SHARD_NODES entry for '{shard_id}' has no URL")
+        if shard_id in nodes:
+            raise ValueError(f"Shard id '{shard_id}' is listed twice in SHARD_NODES")
+        nodes[shard_id] = url.rstrip("/")
+    return nodes
+
+SHARD_ID = os.getenv("SHARD_ID") or None
+SHARD_NODES = parse_shard_nodes(os.getenv("SHARD_NODES", ""))
+if bool(SHARD_ID) != bool(SHARD_NODES):
+    raise ValueError("SHARD_ID and SHARD_NODES must be set together (or both left unset)")
+SHARDING_ENABLED = bool(SHARD_ID and SHARD_NODES)
+if SHARDING_ENABLED and SHARD_ID not in SHARD_NODES:
+    raise ValueError(f"SHARD_ID '{SHARD_ID}' is not listed in SHARD_NODES {list(SHARD_NODES)}")
+
 # ==========================================
 # ACTION SPACE DEFINITION
 # ==========================================
@@ -189,6 +233,249 @@ class RLAgent:
             q_values = self.model(state_tensor)
         return q_values.numpy().tolist()
 
+# ==========================================
+# ONLINE RISK MODEL
+# ==========================================
+class OnlineRiskModel:
+    """
+    Logistic regression over [engagement, reward_score] that keeps learning from real outcomes.
+    Observed outcomes go into a fixed-size ring buffer; every `batch_size` new outcomes trigger one
+    vectorized SGD step on a random mini-batch from that buffer. Memory is bounded by `buffer_size`
+    and each update costs O(batch_size), regardless of how much feedback has been seen.
+    Exposes `predict_proba` with the same shape as sklearn's, so /predict can use it directly.
+    """
+    def __init__(self, n_features=2, learning_rate=0.05, l2=1e-4, batch_size=16, buffer_size=1024):
+        self.n_features = n_features
+        self.learning_rate = learning_rate
+        self.l2 = l2                      # L2 penalty keeps weights from drifting on noisy feedback
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+        # Model parameters
+        self.coef = np.zeros(n_features)
+        self.intercept = 0.0
+        self.version = 0                  # Incremented on every SGD step
+
+        # Ring buffer of observed outcomes (preallocated -> bounded memory)
+        self.X_buf = np.zeros((buffer_size, n_features))
+        self.y_buf = np.zeros(buffer_size)
+        self.buf_pos = 0
+        self.buf_count = 0
+        self.new_since_update = 0
+
+        # Updates come from both Flask request threads and the timeout worker
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_sklearn(cls, model, **kwargs):
+        """Warm-starts the online model from a fitted sklearn LogisticRegression."""
+        online = cls(n_features=model.coef_.shape[1], **kwargs)
+        online.coef = model.coef_[0].astype(float).copy()
+        online.intercept = float(model.intercept_[0])
+        return online
+
+    def predict_proba(self, X):
+        """Returns [[P(churn), P(retained)], ...] for each row in X (sklearn-compatible)."""
+        return self.predict_proba_versioned(X)[0]
+
+    def predict_proba_versioned(self, X):
+        """Same as predict_proba, plus the version of the coefficients that produced it."""
+        X = np.asarray(X, dtype=float)
+        with self.lock:
+            coef, intercept, version = self.coef.copy(), self.intercept, self.version
+        p = 1.0 / (1.0 + np.exp(-(X @ coef + intercept)))
+        return np.column_stack((1.0 - p, p)), version
+
+    def observe(self, features, retained):
+        """
+        Records one real outcome (retained=1 engaged, 0 otherwise).
+        Returns True if this observation triggered an SGD step.
+        """
+        with self.lock:
+            self.X_buf[self.buf_pos] = features
+            self.y_buf[self.buf_pos] = float(retained)
+            self.buf_pos = (self.buf_pos + 1) % self.buffer_size
+            self.buf_count = min(self.buf_count + 1, self.buffer_size)
+            self.new_since_update += 1
+
+            if self.new_since_update < self.batch_size:
+                return False
+            self.new_since_update = 0
+            self._sgd_step()
+            return True
+
+    def _sgd_step(self):
+        """One mini-batch gradient step on the log-loss. Caller must hold self.lock."""
+        idx = np.random.randint(0, self.buf_count, size=self.batch_size)
+        X, y = self.X_buf[idx], self.y_buf[idx]
+
+        p = 1.0 / (1.0 + np.exp(-(X @ self.coef + self.intercept)))
+        error = p - y
+        grad_coef = X.T @ error / self.batch_size + self.l2 * self.coef
+        grad_intercept = float(error.mean())
+
+        self.coef -= self.learning_rate * grad_coef
+        self.intercept -= self.learning_rate * grad_intercept
+        self.version += 1
+
+    def state_dict(self):
+        """Serializable snapshot for the agent checkpoint (outcome buffer is not persisted)."""
+        with self.lock:
+            return {
+                'coef': self.coef.tolist(),
+                'intercept': self.intercept,
+                'version': self.version
+            }
+
+    def stats(self):
+        """Consistent snapshot of parameters and buffer usage for /stats."""
+        with self.lock:
+            return {
+                'version': self.version,
+                'coef': self.coef.tolist(),
+                'intercept': self.intercept,
+                'buf_count': self.buf_count,
+                'buffer_size': self.buffer_size,
+                'batch_size': self.batch_size
+            }
+
+    def load_state_dict(self, state):
+        """Restores coefficients from `state_dict()`. Raises ValueError on a feature-count mismatch."""
+        coef = np.array(state['coef'], dtype=float)
+        if coef.shape != (self.n_features,):
+            raise ValueError(f"risk model expects {self.n_features} coefficients, got shape {coef.shape}")
+        intercept = float(state['intercept'])
+        with self.lock:
+            self.coef = coef
+            self.intercept = intercept
+            self.version = int(state.get('version', 0))
+
+    def average_with(self, states):
+        """Replaces the coefficients with the mean of this model and the given peer state_dicts."""
+        with self.lock:
+            coefs = [self.coef] + [np.array(s['coef'], dtype=float) for s in states]
+            intercepts = [self.intercept] + [float(s['intercept']) for s in states]
+            self.coef = np.mean(coefs, axis=0)
+            self.intercept = float(np.mean(intercepts))
+            self.version += 1
+
+# ==========================================
+# CONSISTENT HASH RING (SHARDING)
+# ==========================================
+class ConsistentHashRing:
+    """
+    Maps keys (user_ids) to shard ids.
+    Each shard is placed on the ring `replicas` times (virtual nodes) so load stays even,
+    and adding/removing a shard only moves the keys adjacent to it.
+    """
+    def __init__(self, shard_ids, replicas=100):
+        points = sorted(
+            (self._hash(f"{shard_id}#{i}"), shard_id)
+            for shard_id in shard_ids for i in range(replicas)
+        )
+        self.hashes = [h for h, _ in points]
+        self.shards = [shard_id for _, shard_id in points]
+
+    @staticmethod
+    def _hash(key):
+        # md5 rather than hash(): must be identical across processes and restarts
+        return int(hashlib.md5(str(key).encode("utf-8")).hexdigest()[:16], 16)
+
+    def get_shard(self, key):
+        """Returns the shard owning `key` (first ring point clockwise from its hash)."""
+        idx = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.shards[idx]
+
+# ==========================================
+# SAMPLING PROFILER (ADMIN DIAGNOSTICS)
+# ==========================================
+class SamplingProfiler:
+    """
+    Low-overhead wall-clock sampler for every Python thread in the process.
+    Every `interval` seconds it snapshots all thread stacks (sys._current_frames) and counts
+    identical stacks, so cost depends on sample rate and stack depth, not on request volume.
+    Output is the collapsed-stack format used by flamegraph.pl, speedscope and py-spy:
+        ThreadName;outer (folder/file.py:10);inner (folder/file.py:20) <count>
+    Threads waiting on a lock show up sitting on the `with ...LOCK` line.
+    """
+    def __init__(self, seconds, interval):
+        self.profile_id = str(uuid.uuid4())
+        self.seconds = seconds
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self._labels = {}  # (code, lineno) -> frame label, avoids re-formatting hot frames
+
+    @staticmethod
+    def _thread_label(thread):
+        # Request threads are named Thread-<n> per request; merge them so they share one root
+        return re.sub(r"^Thread-\d+", "Thread", thread.name).replace(" ", "_").replace(";", ":")
+
+    @property
+    def running(self):
+        return self.finished_at is None
+
+    def _frame_label(self, frame):
+        key = (frame.f_code, frame.f_lineno)
+        label = self._labels.get(key)
+        if label is None:
+            code = frame.f_code
+            # Keep the parent folder so e.g. flask/app.py and our app.py stay distinguishable
+            path = os.path.normpath(code.co_filename).split(os.sep)[-2:]
+            label = f"{code.co_name} ({'/'.join(path)}:{frame.f_lineno})".replace(";", ":")
+            self._labels[key] = label
+        return label
+
+    def run(self):
+        """Samples until `seconds` have elapsed. Meant to run in its own thread."""
+        own_ident = threading.get_ident()
+        self.started_at = utc_now()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                # Re-read names every sample: CPython reuses the idents of finished threads
+                thread_names = {t.ident: self._thread_label(t) for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_label(frame))
+                        frame = frame.f_back
+                    stack.append(thread_names.get(ident, f"Thread-{ident}"))
+                    self.counts[tuple(stack)] += 1  # Leaf first; joined only when exported
+                self.samples += 1
+                # Never sleep past the end of the window
+                time.sleep(max(0.0, min(self.interval, deadline - time.monotonic())))
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.finished_at = utc_now()
+
+    def collapsed(self):
+        """Collapsed stacks, one per line, hottest first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks())
+
+    def stacks(self):
+        """[("root;...;leaf", count), ...] sorted hottest first."""
+        return [(";".join(reversed(stack)), count) for stack, count in self.counts.most_common()]
+
+    def summary(self):
+        return {
+            "profile_id": self.profile_id,
+            "status": "running" if self.running else ("failed" if self.error else "done"),
+            "seconds": self.seconds,
+            "interval_ms": round(self.interval * 1000, 3),
+            "samples": self.samples,
+            "unique_stacks": len(self.counts),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "error": self.error
+        }
+
 # ==========================================
 # HELPER FUNCTIONS
 # ==========================================
@@ -261,9 +548,11 @@ print("=" * 50)
 print("🚀 Initializing SkillQuest RL API...")
 print("=" * 50)
 
-# --- 1. Risk Model (Synthetic Training) ---
+# --- 1. Risk Model (Synthetic Warm Start + Online Updates) ---
 # We train a logistic regression model on synthetic data at startup to predict student churn risk.
-# In production, this would be loaded from a pre-trained file.
+# It only serves as the starting point: the online model below keeps learning from real
+# engagement outcomes (/feedback and timeouts), and its coefficients are restored from the
+# agent checkpoint when one is available.
 print("📊 Training Risk Model...")
 np.random.seed(42)
 n_samples = 1000
@@ -282,34 +571,64 @@ X = np.column_stack((engagement_data, rewards_data))
 X_train, X_test, y_train, y_test = train_test_split(X, y_target, test_size=0.2, random_state=42)
 
 # Train Logic Regression
-risk_model = LogisticRegression()
-risk_model.fit(X_train, y_train)
-print(f"✅ Risk Model Ready (Accuracy: {risk_model.score(X_test, y_test):.2f})")
+base_risk_model = LogisticRegression()
+base_risk_model.fit(X_train, y_train)
+print(f"✅ Risk Model Ready (Accuracy: {base_risk_model.score(X_test, y_test):.2f})")
+
+# Wrap it in the online model (drop-in replacement for predict_proba)
+risk_model = OnlineRiskModel.from_sklearn(
+    base_risk_model,
+    learning_rate=float(os.getenv("RISK_LEARNING_RATE", "0.05")),  # SGD step size
+    batch_size=int(os.getenv("RISK_BATCH_SIZE", "16")),             # Outcomes per SGD step
+    buffer_size=int(os.getenv("RISK_BUFFER_SIZE", "1024"))          # Max outcomes kept in memory
+)
 
 # --- 2. RL Agent ---
 agent = RLAgent()
-MODEL_PATH = 'trained_rl_agent.pth'
+BASE_MODEL_PATH = 'trained_rl_agent.pth'
+# In sharded mode every node checkpoints to its own file (several nodes may share a folder)
+MODEL_PATH = f'trained_rl_agent.{SHARD_ID}.pth' if SHARDING_ENABLED else BASE_MODEL_PATH
 
 # Load existing model if available
-if os.path.exists(MODEL_PATH):
+# A new shard without its own checkpoint starts from the shared base weights,
+# but not from the base replay memory: each shard only trains on its own users' experiences.
+load_path = MODEL_PATH if os.path.exists(MODEL_PATH) else BASE_MODEL_PATH
+MODEL_LOADED_FROM = None  # Checkpoint file actually restored at startup (None = untrained agent)
+if os.path.exists(load_path):
     try:
         # Load checkpoint (handling CPU mapping)
-        checkpoint = torch.load(MODEL_PATH, map_location=torch.device('cpu'), weights_only=False)
+        checkpoint = torch.load(load_path, map_location=torch.device('cpu'), weights_only=False)
         agent.model.load_state_dict(checkpoint['model_state_dict'])
         agent.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         agent.epsilon = checkpoint.get('epsilon', 0.01)
         
         # Load replay memory
-        for exp in checkpoint.get('memory', []):
-            agent.memory.append(exp)
-            
-        print(f"✅ RL Agent Loaded (Epsilon: {agent.epsilon:.3f}, Memory: {len(agent.memory)})")
+        if load_path == MODEL_PATH:
+            for exp in checkpoint.get('memory', []):
+                agent.memory.append(exp)
+
+        # Load online risk model coefficients (older checkpoints don't have them)
+        if 'risk_model' in checkpoint:
+            try:
+                risk_model.load_state_dict(checkpoint['risk_model'])
+                print(f"✅ Risk Model Loaded (Version: {risk_model.stats()['version']})")
+            except Exception as e:
+                print(f"⚠️ Error loading risk model: {e}")
+                print("   Using warm-started risk model instead.")
+
+        MODEL_LOADED_FROM = load_path
+        print(f"✅ RL Agent Loaded from {load_path} (Epsilon: {agent.epsilon:.3f}, Memory: {len(agent.memory)})")
     except Exception as e:
         print(f"⚠️ Error loading model: {e}")
         print("   Using untrained agent instead.")
 else:
     print("⚠️ No trained model found. Using untrained agent.")
-    print(f"   Place '{MODEL_PATH}' in the same folder as app.py")
+    print(f"   Place '{BASE_MODEL_PATH}' in the same folder as app.py")
+
+# --- 3. Shard Ring ---
+shard_ring = ConsistentHashRing(SHARD_NODES.keys()) if SHARDING_ENABLED else None
+if SHARDING_ENABLED:
+    print(f"✅ Sharding Enabled (This node: {SHARD_ID}, Shards: {sorted(SHARD_NODES)})")
 
 # ==========================================
 # PENDING RECOMMENDATIONS STORE
@@ -332,12 +651,35 @@ TIMEOUT_PENALTY = float(os.getenv("TIMEOUT_PENALTY", "-2.0"))    # Penalty for m
 AUTO_SAVE_INTERVAL = int(os.getenv("AUTO_SAVE_INTERVAL", "50"))
 training_updates = 0
 
+# Serializes DQN weight changes (replay training vs. shard weight averaging)
+MODEL_LOCK = threading.Lock()
+
+# Sharded mode settings (ignored in single-node mode)
+SHARD_SYNC_INTERVAL_SECONDS = int(os.getenv("SHARD_SYNC_INTERVAL_SECONDS", "300"))  # How often shard models are averaged
+SHARD_REQUEST_TIMEOUT_SECONDS = float(os.getenv("SHARD_REQUEST_TIMEOUT_SECONDS", "5")) # Timeout for node-to-node calls
+SHARD_MAX_FORWARDS = int(os.getenv("SHARD_MAX_FORWARDS", "4"))                      # Concurrent proxied requests (keep below gunicorn --threads)
+SHARD_FORWARD_HEADER = "X-Shard-Forwarded-By"  # Marks requests already routed by another node
+# Caps worker threads blocked on a peer, so threads stay free for requests peers forward to us
+FORWARD_SLOTS = threading.BoundedSemaphore(SHARD_MAX_FORWARDS)
+
+# Admin profiler settings
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))           # Longest allowed profiling window
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))         # Default sampling interval (100 Hz)
+PROFILE_HISTORY = 5                                                         # Finished profiles kept for download
+PROFILES = OrderedDict()  # { profile_id: SamplingProfiler }, oldest first
+PROFILES_LOCK = threading.Lock()
+
 def utc_now():
     """Returns current UTC timestamp."""
     return datetime.now(timezone.utc)
 
 def new_recommendation_id():
-    """Generates a unique ID for each recommendation request."""
+    """
+    Generates a unique ID for each recommendation request.
+    In sharded mode the ID is prefixed with the owning shard ("s0.<uuid>") so feedback can be routed back.
+    """
+    if SHARDING_ENABLED:
+        return f"{SHARD_ID}.{uuid.uuid4()}"
     return str(uuid.uuid4())
 
 # -- Thread-safe accessors for PENDING dict --
@@ -357,23 +699,27 @@ def list_pending():
 def save_checkpoint():
     """Saves the current model state and memory to disk."""
     try:
-        # Save only the last 500 experiences to keep file size manageable
-        memory_to_save = []
-        for state, action, reward, next_state, done in list(agent.memory)[-500:]:
-            memory_to_save.append((
-                state.tolist() if hasattr(state, 'tolist') else list(state),
-                action,
-                reward,
-                next_state.tolist() if hasattr(next_state, 'tolist') else list(next_state),
-                done
-            ))
-            
-        checkpoint = {
-            'model_state_dict': agent.model.state_dict(),
-            'optimizer_state_dict': agent.optimizer.state_dict(),
-            'epsilon': agent.epsilon,
-            'memory': memory_to_save
-        }
+        # Snapshot under MODEL_LOCK so weights, Adam state and memory all come from the same
+        # moment (no replay step or shard averaging half-applied); write to disk after releasing it.
+        with MODEL_LOCK:
+            # Save only the last 500 experiences to keep file size manageable
+            memory_to_save = []
+            for state, action, reward, next_state, done in list(agent.memory)[-500:]:
+                memory_to_save.append((
+                    state.tolist() if hasattr(state, 'tolist') else list(state),
+                    action,
+                    reward,
+                    next_state.tolist() if hasattr(next_state, 'tolist') else list(next_state),
+                    done
+                ))
+
+            checkpoint = {
+                'model_state_dict': copy.deepcopy(agent.model.state_dict()),
+                'optimizer_state_dict': copy.deepcopy(agent.optimizer.state_dict()),
+                'epsilon': agent.epsilon,
+                'memory': memory_to_save,
+                'risk_model': risk_model.state_dict()
+            }
         torch.save(checkpoint, MODEL_PATH)
         print(f"[RL] Auto-saved checkpoint to {MODEL_PATH}")
         return True
@@ -388,19 +734,36 @@ def apply_model_update(context, action, reward, reason="feedback"):
     2. Triggers a replay training step.
     3. Auto-saves if interval is reached.
     """
-    agent.remember(context, action, reward, context, True)
-    trained = agent.replay(batch_size=32)
+    global training_updates
+    save_due = False
+    with MODEL_LOCK:
+        agent.remember(context, action, reward, context, True)
+        trained = agent.replay(batch_size=32)
+        if trained:
+            training_updates += 1
+            save_due = training_updates % AUTO_SAVE_INTERVAL == 0
     
     print(f"[RL] Update ({reason}) -> action={ACTION_SPACE[action]['code']} reward={reward} trained={trained}")
     
-    global training_updates
-    if trained:
-        training_updates += 1
-        if training_updates % AUTO_SAVE_INTERVAL == 0:
-            save_checkpoint()
-            
+    # save_checkpoint() takes MODEL_LOCK itself
+    if save_due:
+        save_checkpoint()
+
     return trained
 
+def apply_risk_update(rec, engaged, reason="feedback"):
+    """
+    Feeds a real outcome back into the online risk model.
+    Uses the [engagement, reward_score] inputs stored with the recommendation at /predict time.
+    """
+    features = rec.get("risk_features")
+    if features is None:
+        return False  # Recommendation issued before risk features were stored
+    updated = risk_model.observe(features, retained=1 if engaged else 0)
+    if updated:
+        print(f"[Risk] Update ({reason}) -> version={risk_model.stats()['version']}")
+    return updated
+
 def check_timeouts_loop():
     """
     Background worker thread.
@@ -430,6 +793,7 @@ def check_timeouts_loop():
                         reward=TIMEOUT_PENALTY,
                         reason="timeout"
                     )
+                    apply_risk_update(popped, engaged=False, reason="timeout")
                     print(f"[TimeoutWorker] Penalized recommendation_id={popped['recommendation_id']} user_id={popped['user_id']}")
                     
         except Exception as e:
@@ -438,7 +802,152 @@ def check_timeouts_loop():
         time.sleep(LOOP_INTERVAL_SECONDS)
 
 # Launch the timeout worker in daemon mode (dies when main app dies)
-threading.Thread(target=check_timeouts_loop, daemon=True).start()
+threading.Thread(target=check_timeouts_loop, name="TimeoutWorker", daemon=True).start()
+
+# ==========================================
+# SHARD ROUTING & WEIGHT AVERAGING
+# ==========================================
+# In sharded mode each node owns the users that hash to it: their pending recommendations,
+# their replay memory and the training updates they produce. Requests that land on the wrong
+# node are forwarded once to the owner, and a background worker periodically averages the
+# DQN and risk model weights of all shards so every node benefits from everyone's feedback.
+
+def shard_for_user(user_id):
+    """Returns the shard id that owns `user_id` (this node in single-node mode)."""
+    if not SHARDING_ENABLED:
+        return SHARD_ID
+    return shard_ring.get_shard(user_id)
+
+def shard_for_recommendation(recommendation_id):
+    """Reads the owning shard from the recommendation_id prefix (unprefixed IDs are local)."""
+    if not SHARDING_ENABLED:
+        return SHARD_ID
+    prefix = str(recommendation_id).split(".", 1)[0]
+    return prefix if prefix in SHARD_NODES else SHARD_ID
+
+def is_trusted_forward():
+    """
+    True if the current request was forwarded by a peer shard.
+    The forward header alone is not enough (any client can set it): with API_KEY configured the
+    request must also carry the shared key; in dev mode it must come from that peer's host.
+    """
+    origin = request.headers.get(SHARD_FORWARD_HEADER)
+    if not SHARDING_ENABLED or origin not in SHARD_NODES or origin == SHARD_ID:
+        return False
+    if API_KEY:
+        return request.headers.get("X-API-Key") == API_KEY
+    return PEER_ADDRESSES.get(origin) == request.remote_addr
+
+def resolve_peer_addresses():
+    """
+    Resolves each peer's host once at startup (dev-mode forward check), so request threads
+    never block on DNS. Unresolvable peers map to None and their forwards are not trusted.
+    """
+    addresses = {}
+    for shard_id, url in SHARD_NODES.items():
+        if shard_id == SHARD_ID:
+            continue
+        try:
+            addresses[shard_id] = socket.gethostbyname(urllib.parse.urlparse(url).hostname)
+        except (OSError, TypeError, UnicodeError) as e:
+            print(f"[Shard] Could not resolve peer {shard_id} ({url}): {e}")
+            addresses[shard_id] = None
+    return addresses
+
+PEER_ADDRESSES = resolve_peer_addresses() if SHARDING_ENABLED and not API_KEY else {}
+
+def should_forward(shard_id):
+    """True if the request belongs to another shard and hasn't already been forwarded by a peer (no loops)."""
+    return SHARDING_ENABLED and shard_id != SHARD_ID and not is_trusted_forward()
+
+def shard_request(shard_id, path, payload=None, api_key=None):
+    """Calls another node's endpoint. Returns (status_code, raw_body)."""
+    headers = {"Content-Type": "application/json", SHARD_FORWARD_HEADER: SHARD_ID}
+    if api_key:
+        headers["X-API-Key"] = api_key
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(SHARD_NODES[shard_id] + path, data=data, headers=headers,
+                                 method="POST" if data is not None else "GET")
+    try:
+        with urllib.request.urlopen(req, timeout=SHARD_REQUEST_TIMEOUT_SECONDS) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+def forward_to_shard(shard_id, path, payload):
+    """
+    Proxies the current request to the owning shard and relays its response unchanged.
+    Sent with this node's API_KEY so the owner can trust the forward header; callers must
+    check require_api_key() first for protected endpoints.
+    If all SHARD_MAX_FORWARDS slots are busy, replies 503 with Retry-After instead of blocking
+    another worker thread, so two nodes forwarding to each other can't exhaust each other's
+    threads. (Peer URLs are internal addresses, so clients are never redirected to them.)
+    """
+    if not FORWARD_SLOTS.acquire(blocking=False):
+        response = jsonify({"success": False, "error": "Shard routing is busy, retry shortly"})
+        response.headers["Retry-After"] = "1"
+        return response, 503
+    try:
+        status, body = shard_request(shard_id, path, payload, api_key=API_KEY)
+    except (urllib.error.URLError, OSError) as e:
+        return jsonify({"success": False, "error": f"Shard '{shard_id}' unreachable: {e}"}), 502
+    finally:
+        FORWARD_SLOTS.release()
+    return Response(body, status=status, mimetype="application/json")
+
+def get_shard_weights():
+    """Serializable snapshot of this node's DQN and risk model weights."""
+    with MODEL_LOCK:
+        dqn = {name: tensor.tolist() for name, tensor in agent.model.state_dict().items()}
+    return {"shard_id": SHARD_ID, "dqn": dqn, "risk_model": risk_model.state_dict()}
+
+def average_shard_weights():
+    """
+    Pulls the weights of every reachable peer and replaces the local models with the mean.
+    Unreachable peers are skipped (their users' updates are merged on a later round).
+    Returns the list of shard ids that took part.
+    """
+    peers = []
+    for shard_id in SHARD_NODES:
+        if shard_id == SHARD_ID:
+            continue
+        try:
+            status, body = shard_request(shard_id, "/shard/weights", api_key=API_KEY)
+            if status == 200:
+                peers.append(json.loads(body))
+            else:
+                print(f"[ShardSync] Skipping {shard_id}: HTTP {status}")
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"[ShardSync] Skipping {shard_id}: {e}")
+
+    if not peers:
+        return [SHARD_ID]
+
+    with MODEL_LOCK:
+        merged = {}
+        for name, tensor in agent.model.state_dict().items():
+            stacked = [tensor] + [torch.tensor(p["dqn"][name], dtype=tensor.dtype) for p in peers]
+            merged[name] = torch.stack(stacked).mean(dim=0)
+        agent.model.load_state_dict(merged)
+        # Inside MODEL_LOCK too, so a checkpoint never pairs merged DQN weights with an unmerged risk model
+        risk_model.average_with([p["risk_model"] for p in peers])
+
+    merged_with = [SHARD_ID] + [p["shard_id"] for p in peers]
+    print(f"[ShardSync] Averaged weights across shards: {merged_with}")
+    return merged_with
+
+def shard_sync_loop():
+    """Background worker thread: periodically averages the shard models."""
+    print("[ShardSync] Started. Averaging shard weights every", SHARD_SYNC_INTERVAL_SECONDS, "seconds")
+    while True:
+        time.sleep(SHARD_SYNC_INTERVAL_SECONDS)
+        try:
+            average_shard_weights()
+        except Exception as e:
+            print("[ShardSync] Error:", e)
+
+if SHARDING_ENABLED:
+    threading.Thread(target=shard_sync_loop, name="ShardSync", daemon=True).start()
 
 print("=" * 50)
 print("✅ API Ready!")
@@ -472,7 +981,11 @@ def home():
             "POST /predict": "Get action prediction (returns recommendation_id + expires_at)",
             "POST /feedback": "Send only recommendation_id and engaged=true if the student engaged",
             "GET /stats": "Get model statistics",
-            "POST /save": "Save current model checkpoint"
+            "POST /save": "Save current model checkpoint",
+            "GET /shard/weights": "Current model weights (sharded mode, used for averaging)",
+            "POST /shard/sync": "Average this node's model weights with its peers now (sharded mode, peers are not updated)",
+            "POST /admin/profile": "Start a sampling profiler for N seconds (returns profile_id)",
+            "GET /admin/profile/<profile_id>": "Collapsed-stack profile output (flamegraph-ready)"
         }
     })
 
@@ -481,9 +994,10 @@ def health():
     """Health check endpoint for monitoring."""
     return jsonify({
         "status": "healthy",
-        "model_loaded": os.path.exists(MODEL_PATH),
+        "model_loaded": MODEL_LOADED_FROM is not None,
         "agent_epsilon": agent.epsilon,
-        "memory_size": len(agent.memory)
+        "memory_size": len(agent.memory),
+        "shard_id": SHARD_ID
     })
 
 @app.route('/actions', methods=['GET'])
@@ -516,6 +1030,11 @@ def predict():
             return jsonify({"success": False, "error": f"Missing required fields: {missing_fields}"}), 400
 
         user_id = data['user_id']
+
+        # Sharded mode: users are served by the node that owns them
+        owner = shard_for_user(user_id)
+        if should_forward(owner):
+            return forward_to_shard(owner, '/predict', data)
         
         # Prepare User Data Dictionary
         user_data = {
@@ -546,7 +1065,8 @@ def predict():
 
         # 2. Predict Risk
         student_features = np.array([[engagement, reward_score]])
-        retention_prob = risk_model.predict_proba(student_features)[0][1]
+        retention_proba, risk_version = risk_model.predict_proba_versioned(student_features)
+        retention_prob = retention_proba[0][1]
         risk_score = 1.0 - retention_prob
         risk_level = "high" if risk_score > 0.6 else ("medium" if risk_score > 0.35 else "low")
 
@@ -568,6 +1088,7 @@ def predict():
             "user_id": user_id,
             "action_id": action_id,
             "state": state_vector.tolist(),
+            "risk_features": [engagement, reward_score],
             "created_at": utc_now().isoformat(),
             "expires_at": expires_at
         })
@@ -589,7 +1110,8 @@ def predict():
                 "engagement_score": round(engagement, 4),
                 "reward_score": round(reward_score, 4),
                 "risk_score": round(risk_score, 4),
-                "risk_level": risk_level
+                "risk_level": risk_level,
+                "risk_model_version": risk_version
             },
             "all_action_scores": {
                 ACTION_SPACE[i]['code']: round(q, 4) for i, q in enumerate(q_values)
@@ -620,6 +1142,11 @@ def feedback():
         if not recommendation_id:
             return jsonify({"success": False, "error": "recommendation_id is required"}), 400
 
+        # Sharded mode: the recommendation is pending on the node that issued it
+        owner = shard_for_recommendation(recommendation_id)
+        if should_forward(owner):
+            return forward_to_shard(owner, '/feedback', data)
+
         # Retrieve the original state and action from pending store
         rec = pop_pending(recommendation_id)
         if not rec:
@@ -634,6 +1161,7 @@ def feedback():
 
         # Train Model
         trained = apply_model_update(context=last_state, action=last_action, reward=reward, reason="feedback")
+        risk_updated = apply_risk_update(rec, engaged=engaged, reason="feedback")
 
         return jsonify({
             "success": True,
@@ -646,8 +1174,10 @@ def feedback():
             "model_stats": {
                 "memory_size": len(agent.memory),
                 "epsilon": round(agent.epsilon, 4),
+                "risk_model_version": risk_model.stats()['version']
             },
-            "training_performed": trained
+            "training_performed": trained,
+            "risk_model_updated": risk_updated
         })
 
     except Exception as e:
@@ -656,15 +1186,32 @@ def feedback():
 @app.route('/stats', methods=['GET'])
 def stats():
     """Returns internal model statistics for admins."""
+    risk_state = risk_model.stats()
     return jsonify({
         "success": True,
         "model": {
-            "loaded": os.path.exists(MODEL_PATH),
+            "loaded": MODEL_LOADED_FROM is not None,
+            "loaded_from": MODEL_LOADED_FROM,
             "path": MODEL_PATH,
             "epsilon": round(agent.epsilon, 4),
             "memory_size": len(agent.memory),
             "memory_capacity": agent.memory.maxlen
         },
+        "risk_model": {
+            "version": risk_state['version'],
+            "coefficients": [round(c, 4) for c in risk_state['coef']],
+            "intercept": round(risk_state['intercept'], 4),
+            "outcomes_buffered": risk_state['buf_count'],
+            "buffer_capacity": risk_state['buffer_size'],
+            "batch_size": risk_state['batch_size']
+        },
+        "sharding": {
+            "enabled": SHARDING_ENABLED,
+            "shard_id": SHARD_ID,
+            "nodes": SHARD_NODES,
+            "sync_interval_seconds": SHARD_SYNC_INTERVAL_SECONDS,
+            "max_concurrent_forwards": SHARD_MAX_FORWARDS
+        },
         "pending_recommendations": len(list_pending()),
         "actions_available": len(ACTION_SPACE),
         "timeout_policy_hours": TIMEOUT_HOURS,
@@ -686,6 +1233,96 @@ def save_model():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/shard/weights', methods=['GET'])
+def shard_weights():
+    """Returns this node's model weights so peers can average them (sharded mode only)."""
+    if not require_api_key():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    if not SHARDING_ENABLED:
+        return jsonify({"success": False, "error": "Sharding is not enabled"}), 400
+    return jsonify(get_shard_weights())
+
+@app.route('/shard/sync', methods=['POST'])
+def shard_sync():
+    """
+    Manually trigger a weight-averaging round on this node.
+    Pulls every peer's weights and replaces only this node's models with the mean;
+    peers pick up the result on their own ShardSync round (or their own /shard/sync call).
+    """
+    if not require_api_key():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    if not SHARDING_ENABLED:
+        return jsonify({"success": False, "error": "Sharding is not enabled"}), 400
+
+    try:
+        merged_with = average_shard_weights()
+        return jsonify({"success": True, "shard_id": SHARD_ID, "merged_with": merged_with})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/admin/profile', methods=['POST'])
+def start_profile():
+    """
+    Starts a sampling profiler across all threads (request handlers, TimeoutWorker, ShardSync).
+    Runs in the background so the API keeps serving real traffic while it is being profiled;
+    fetch the result from GET /admin/profile/<profile_id> once `seconds` have elapsed.
+    """
+    if not require_api_key():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+
+    try:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"success": False, "error": "JSON body must be an object"}), 400
+        try:
+            seconds = float(data.get('seconds', request.args.get('seconds', 10)))
+            interval_ms = float(data.get('interval_ms', request.args.get('interval_ms', PROFILE_INTERVAL_MS)))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "seconds and interval_ms must be numbers"}), 400
+
+        if not (math.isfinite(seconds) and 0 < seconds <= PROFILE_MAX_SECONDS):
+            return jsonify({"success": False, "error": f"seconds must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+        if not (math.isfinite(interval_ms) and 1 <= interval_ms <= seconds * 1000):
+            return jsonify({"success": False, "error": "interval_ms must be between 1 and seconds * 1000"}), 400
+
+        with PROFILES_LOCK:
+            if any(p.running for p in PROFILES.values()):
+                return jsonify({"success": False, "error": "A profile is already running"}), 409
+            profiler = SamplingProfiler(seconds, interval_ms / 1000.0)
+            PROFILES[profiler.profile_id] = profiler
+            while len(PROFILES) > PROFILE_HISTORY:
+                PROFILES.popitem(last=False)
+
+        threading.Thread(target=profiler.run, name="Profiler", daemon=True).start()
+        return jsonify({
+            "success": True,
+            **profiler.summary(),
+            "result_url": f"/admin/profile/{profiler.profile_id}"
+        }), 202
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/admin/profile/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Returns a finished profile as collapsed stacks (text/plain, pipe into flamegraph.pl
+    or load into speedscope). Use ?format=json for the same data plus metadata.
+    While the profile is still running, returns 202 with its progress.
+    """
+    if not require_api_key():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+
+    with PROFILES_LOCK:
+        profiler = PROFILES.get(profile_id)
+    if profiler is None:
+        return jsonify({"success": False, "error": "Unknown profile_id"}), 404
+    if profiler.running:
+        return jsonify({"success": True, **profiler.summary()}), 202
+
+    if request.args.get('format') == 'json':
+        return jsonify({"success": True, **profiler.summary(), "stacks": dict(profiler.stacks())})
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
 # ==========================================
 # RUN THE SERVER
 # ==========================================
@@ -700,6 +1337,10 @@ if __name__ == '__main__':
     print("   POST /feedback   - Record Feedback (send recommendation_id + engaged)")
     print("   GET  /stats      - Model Statistics")
     print("   POST /save       - Save Model")
+    print("   GET  /shard/weights - Model Weights (sharded mode)")
+    print("   POST /shard/sync - Average This Node's Weights With Peers (sharded mode)")
+    print("   POST /admin/profile - Start Sampling Profiler")
+    print("   GET  /admin/profile/<id> - Profile Output (collapsed stacks)")
     print("=" * 50)
     
     port = int(os.environ.get('PORT', 8000))